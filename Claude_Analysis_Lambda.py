@@ -1,42 +1,448 @@
 import json
+import re
 import boto3
 import logging
 from datetime import datetime
 import time
-import random
+from botocore.config import Config
 from botocore.exceptions import ClientError
 import os
 import traceback
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # --- Standard Setup ---
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-s3_client = boto3.client('s3')
-bedrock_client = boto3.client('bedrock-runtime', region_name='us-east-1')
+OUTPUT_BUCKET = 'de-processing-bucket'
+MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
+# Number of attribute batches analysed concurrently. Throttling is retried by the clients' adaptive retry mode.
+MAX_WORKERS = int(os.environ.get('BEDROCK_MAX_WORKERS', '8'))
 
+# Clients are created once per container and reused across warm invocations and worker threads.
+# The connection pool is sized to the thread pool so concurrent calls never queue for a socket.
+client_config = Config(
+    retries={'max_attempts': 10, 'mode': 'adaptive'},
+    max_pool_connections=max(16, MAX_WORKERS),
+    connect_timeout=5,
+    read_timeout=120,
+    tcp_keepalive=True
+)
+s3_client = boto3.client('s3', config=client_config)
+bedrock_client = boto3.client('bedrock-runtime', region_name='us-east-1', config=client_config)
 
-# --- NO CHANGES TO YOUR CORE LOGIC FUNCTIONS BELOW ---
+# Attributes analysed per Claude call; keep small enough that the reply fits in maxTokens. 1 disables batching.
+ATTRIBUTE_BATCH_SIZE = max(1, int(os.environ.get('ATTRIBUTE_BATCH_SIZE', '3')))
+# 'optimized' requests Bedrock latency-optimized inference; only some models/regions support it.
+LATENCY_MODE = os.environ.get('BEDROCK_LATENCY_MODE', 'standard')
+# Marks the shared SOP prefix as cacheable so it is not re-processed for every attribute.
+PROMPT_CACHING = os.environ.get('BEDROCK_PROMPT_CACHING', 'false').lower() == 'true'
+# Pretty-print the saved analysis JSON; it is only read by the next Lambda, so compact by default.
+DEBUG_JSON = os.environ.get('DEBUG_JSON', 'false').lower() == 'true'
+# Client-side pacing: at most this many Bedrock requests are started in any 60 second window. 0 or less disables pacing.
+REQUESTS_PER_MINUTE = int(os.environ.get('BEDROCK_REQUESTS_PER_MINUTE', '60'))
+_request_times = deque()
+_request_lock = threading.Lock()
 
-def invoke_model_with_retry(bedrock_client, model_id, body, max_retries=5):
-    """Invoke model with exponential backoff retry logic"""
-    for attempt in range(max_retries):
+# DE templates change rarely; keep the parsed template per (bucket, key) for warm invocations.
+_TEMPLATE_CACHE = {}
+
+_json_decoder = json.JSONDecoder()
+
+# Per-batch SOP filtering: send only sections matching the attributes' keywords.
+# Off by default because it gives every batch a different prompt prefix, which defeats prompt caching.
+SECTION_FILTER = os.environ.get('SOP_SECTION_FILTER', 'false').lower() == 'true'
+SECTION_FILTER_MIN_CHARS = int(os.environ.get('SOP_SECTION_FILTER_MIN_CHARS', '2000'))
+_KEYWORD_REGEX = re.compile(r"[A-Za-z]{4,}")
+_KEYWORD_STOPWORDS = frozenset({
+    "does", "there", "that", "this", "with", "from", "have", "which", "what", "when", "where",
+    "whether", "their", "they", "been", "being", "into", "through", "each", "such", "should",
+    "would", "could", "other", "than", "then", "also", "only", "were", "will", "shall", "control"
+})
+
+
+# --- Core Logic Functions ---
+
+def _wait_for_request_slot():
+    """Blocks only when REQUESTS_PER_MINUTE requests have already been started in the last 60 seconds."""
+    if REQUESTS_PER_MINUTE <= 0:
+        return
+    while True:
+        with _request_lock:
+            now = time.monotonic()
+            while _request_times and now - _request_times[0] >= 60:
+                _request_times.popleft()
+            if len(_request_times) < REQUESTS_PER_MINUTE:
+                _request_times.append(now)
+                return
+            wait_time = 60 - (now - _request_times[0])
+        logger.info(f"Request rate limit reached. Waiting {wait_time:.2f} seconds...")
+        time.sleep(wait_time)
+
+
+def converse_with_retry(bedrock_client, model_id, messages, latency_mode=LATENCY_MODE):
+    """
+    Call the Bedrock Converse API once per rate-limiter slot.
+    Throttled requests are retried by the client's adaptive retry mode, which also backs off its send rate.
+    """
+    request = {
+        "modelId": model_id,
+        "messages": messages,
+        "inferenceConfig": {"maxTokens": 5000}
+    }
+    if latency_mode != 'standard':
+        request["performanceConfig"] = {"latency": latency_mode}
+    _wait_for_request_slot()
+    return bedrock_client.converse(**request)
+
+
+def _load_de_template(bucket, key):
+    """
+    Returns the parsed DE template, reusing the cached copy while its ETag is unchanged.
+    A conditional GET answers 304 without a body when the cached copy is still current.
+    """
+    cached = _TEMPLATE_CACHE.get((bucket, key))
+    request = {"Bucket": bucket, "Key": key}
+    if cached:
+        request["IfNoneMatch"] = cached['etag']
+    try:
+        response = s3_client.get_object(**request)
+    except ClientError as e:
+        if cached and e.response['Error']['Code'] in ('304', 'NotModified'):
+            logger.info(f"Using cached DE template for s3://{bucket}/{key}")
+            return cached['value']
+        raise
+    de_template = json.load(response['Body'])
+    _TEMPLATE_CACHE[(bucket, key)] = {'etag': response['ETag'], 'value': de_template}
+    return de_template
+
+
+def _select_sop_sections(sop_data, template_items):
+    """
+    Serializes only the SOP sections that mention keywords from the attributes' names and
+    questions. Falls back to the full SOP when too little text matches.
+    """
+    if not isinstance(sop_data, list):
+        return json.dumps(sop_data, separators=(',', ':'))
+    section_texts = [json.dumps(section, separators=(',', ':')) for section in sop_data]
+    full_text = "[" + ",".join(section_texts) + "]"
+
+    # Word prefixes act as crude stems, e.g. "responsibilities" also matches "responsible".
+    stems = {
+        word.lower()[:6]
+        for item in template_items
+        for word in _KEYWORD_REGEX.findall(f"{item.get('Attribute', '')} {item.get('Required Questions', '')}")
+        if word.lower() not in _KEYWORD_STOPWORDS
+    }
+    if not stems:
+        return full_text
+    stem_regex = re.compile("|".join(map(re.escape, sorted(stems))), re.IGNORECASE)
+
+    selected_text = "[" + ",".join(
+        text for section, text in zip(sop_data, section_texts)
+        if (isinstance(section, dict) and section.get("Section") == "Document Information") or stem_regex.search(text)
+    ) + "]"
+    if len(selected_text) < SECTION_FILTER_MIN_CHARS:
+        return full_text
+    logger.info(f"Sending {len(selected_text)} of {len(full_text)} SOP characters for {[item.get('Attribute') for item in template_items]}.")
+    return selected_text
+
+
+def _build_sop_blocks(sop_text_for_prompt):
+    """
+    Builds the content blocks holding the SOP and the response format.
+    They are identical for every request, so they lead the prompt and can be cached by Bedrock.
+    """
+    blocks = [{
+        "text": f"""SOP: {sop_text_for_prompt}
+
+You will be asked to analyze this SOP for one or more DE template attributes.
+For each attribute, answer with a JSON object in this format:
+{{
+  "attribute": "attribute name",
+  "required_answer": "answer",
+  "consideration_answers": ["answer1", "answer2"],
+  "evidence": [{{"section": "name", "relevance": "why"}}],
+  "comment": "summary"
+}}"""
+    }]
+    if PROMPT_CACHING:
+        blocks.append({"cachePoint": {"type": "default"}})
+    return blocks
+
+
+def _is_attribute_answer(value):
+    """True for a decoded value shaped like one attribute's answer object."""
+    return isinstance(value, dict) and ('required_answer' in value or 'attribute' in value)
+
+
+def _is_attribute_answer_list(value):
+    """True for a decoded value shaped like the batch reply: a list holding answer objects."""
+    return isinstance(value, list) and any(_is_attribute_answer(item) for item in value)
+
+
+def _extract_json(claude_text, open_char, is_expected):
+    """
+    Parses the first JSON value starting at an open_char ('{' or '[') in the model response
+    for which is_expected holds. raw_decode stops at the end of that value, so trailing prose
+    or later fragments are ignored. Nested values of the wrong shape, e.g. an evidence entry
+    inside a truncated reply, are skipped rather than returned.
+    """
+    start = claude_text.find(open_char)
+    if start == -1:
+        raise ValueError("No JSON value found in model response.")
+    while start != -1:
         try:
-            response = bedrock_client.invoke_model(
-                modelId=model_id,
-                body=json.dumps(body)
-            )
-            return response
-        except ClientError as e:
-            if e.response['Error']['Code'] == 'ThrottlingException':
-                if attempt < max_retries - 1:
-                    wait_time = (2 ** attempt) + random.uniform(0, 1)
-                    logger.info(f"Throttled on attempt {attempt + 1}. Retrying in {wait_time:.2f} seconds...")
-                    time.sleep(wait_time)
-                    continue
-                else:
-                    logger.error("Max retries reached for throttling")
-            raise e
+            value = _json_decoder.raw_decode(claude_text, start)[0]
+            if is_expected(value):
+                return value
+        except ValueError:
+            pass
+        start = claude_text.find(open_char, start + 1)
+    raise ValueError("Could not parse valid JSON from model response.")
+
+
+def _parse_claude_json(claude_text):
+    """Extracts the JSON object from the model response, tolerating any surrounding prose."""
+    if claude_text.find('{') == -1:
+        return {"comment": "No JSON object found in model response."}
+    try:
+        return _extract_json(claude_text, '{', _is_attribute_answer)
+    except ValueError:
+        return {"comment": "Could not parse valid JSON from model response."}
+
+
+def _ask_claude(sop_blocks, request_prompt):
+    """Sends the shared SOP prefix plus a request-specific prompt and returns the reply text."""
+    messages = [{
+        "role": "user",
+        "content": sop_blocks + [{"text": request_prompt}]
+    }]
+    response = converse_with_retry(bedrock_client, MODEL_ID, messages)
+    return response['output']['message']['content'][0]['text']
+
+
+def _build_result(template_item, claude_json):
+    """Maps the model's JSON answer for one attribute onto the output result row."""
+    considerations = template_item.get('Considerations', '')
+    return {
+        "Attribute": template_item.get('Attribute', 'Unknown'),
+        "Required Question": template_item.get('Required Questions', ''),
+        "Considerations": considerations.split('\n') if considerations else [],
+        "Answers": claude_json.get('required_answer', ''),
+        "Evidence": claude_json.get('evidence', []),
+        "Comment": claude_json.get('comment', '')
+    }
+
+
+def _failed_result(attribute, error):
+    """Logs the failure and returns the result row recorded for an attribute that could not be processed."""
+    logger.error(f"Error processing attribute '{attribute}': {str(error)}")
+    return {
+        "Attribute": attribute,
+        "Answers": f"Error: {str(error)}",
+        "Comment": f"Processing failed for this attribute: {str(error)}"
+    }
+
+
+def _analyze_attribute(template_item, sop_blocks):
+    """Run the Claude analysis for a single DE template attribute and return its result row."""
+    attribute = template_item.get('Attribute', 'Unknown')
+    try:
+        logger.info(f"Analyzing attribute '{attribute}'. Sending {len(sop_blocks[0]['text'])} characters to the model.")
+        
+        attribute_prompt = f"""Analyze this SOP for "{attribute}".
+
+Question: {template_item.get('Required Questions', '')}
+Considerations: {template_item.get('Considerations', '')}
+
+Respond ONLY with the JSON object, with no text before or after it."""
+        
+        claude_json = _parse_claude_json(_ask_claude(sop_blocks, attribute_prompt))
+        result = _build_result(template_item, claude_json)
+        logger.info(f"Successfully processed attribute: {attribute}")
+        return result
+    
+    except Exception as e:
+        return _failed_result(attribute, e)
+
+
+def _analyze_attribute_batch(template_items, sop_blocks):
+    """
+    Analyzes several attributes with a single Claude call so the SOP context is sent once.
+    Attributes missing from the reply (or the whole batch, if the reply cannot be parsed)
+    fall back to one call per attribute.
+    """
+    if len(template_items) == 1:
+        return [_analyze_attribute(template_items[0], sop_blocks)]
+
+    attribute_names = [item.get('Attribute', 'Unknown') for item in template_items]
+    answers = {}
+    try:
+        logger.info(f"Analyzing attributes {attribute_names} in one request.")
+        attribute_specs = json.dumps([{
+            "attribute": item.get('Attribute', 'Unknown'),
+            "question": item.get('Required Questions', ''),
+            "considerations": item.get('Considerations', '')
+        } for item in template_items], indent=2)
+        batch_prompt = f"""Analyze this SOP for each of the following attributes.
+
+ATTRIBUTES: {attribute_specs}
+
+Respond ONLY with a JSON array holding one object per attribute, in the same order, with no text before or after it."""
+        
+        claude_answers = _extract_json(_ask_claude(sop_blocks, batch_prompt), '[', _is_attribute_answer_list)
+        for claude_json in claude_answers:
+            if isinstance(claude_json, dict):
+                answers.setdefault(claude_json.get('attribute'), claude_json)
+    except Exception as e:
+        logger.warning(f"Batch analysis failed for {attribute_names}, falling back to per-attribute calls: {str(e)}")
+
+    results = []
+    for item, attribute in zip(template_items, attribute_names):
+        if attribute in answers:
+            try:
+                results.append(_build_result(item, answers[attribute]))
+                logger.info(f"Successfully processed attribute: {attribute}")
+            except Exception as e:
+                results.append(_failed_result(attribute, e))
+        else:
+            results.append(_analyze_attribute(item, sop_blocks))
+    return results
+
+
+def _prepare_analysis(sop_input, template_input):
+    """
+    Loads the SOP and DE template for one analysis request and splits the template
+    into attribute batches ready to be sent to Claude.
+    """
+    sop_bucket = sop_input['s3_bucket']
+    sop_key = sop_input['s3_key']
+    
+    template_bucket = template_input['s3_bucket']
+    template_key = template_input['s3_key']
+
+    logger.info(f"Processing SOP: s3://{sop_bucket}/{sop_key}")
+    logger.info(f"Using Template: s3://{template_bucket}/{template_key}")
+
+    # Define the output file location. This logic is adapted from your original code.
+    sop_base_filename = os.path.splitext(os.path.basename(sop_key))[0]
+    if sop_base_filename.endswith('_processed'):
+        sop_base_filename = sop_base_filename.replace('_processed', '')
+    
+    output_filename = f"{sop_base_filename}_claude_analysis.json"
+    output_key = f"analysis_results/{output_filename}"
+
+    # Retrieve and load the input files from S3. The template is fetched on a
+    # background thread so the two S3 round trips overlap.
+    with ThreadPoolExecutor(max_workers=1) as loader:
+        template_future = loader.submit(_load_de_template, template_bucket, template_key)
+        if 'inline' in sop_input:
+            # The structuring step passes small SOPs in the payload, so no S3 read is needed.
+            sop_data = sop_input['inline']
+        else:
+            sop_response = s3_client.get_object(Bucket=sop_bucket, Key=sop_key)
+            sop_data = json.load(sop_response['Body'])
+        de_template = template_future.result()
+    if isinstance(de_template, dict):
+        de_template = [de_template]
+        
+    batches = [de_template[i:i + ATTRIBUTE_BATCH_SIZE] for i in range(0, len(de_template), ATTRIBUTE_BATCH_SIZE)]
+    if SECTION_FILTER:
+        batches = [(batch, _build_sop_blocks(_select_sop_sections(sop_data, batch))) for batch in batches]
+    else:
+        # Compact separators: Claude does not need pretty-printing and whitespace costs input tokens.
+        sop_blocks = _build_sop_blocks(json.dumps(sop_data, separators=(',', ':')))
+        batches = [(batch, sop_blocks) for batch in batches]
+
+    return {
+        "source_sop_file": f"s3://{sop_bucket}/{sop_key}",
+        "output_key": output_key,
+        "batches": batches
+    }
+
+
+def _run_analyses(analyses):
+    """
+    Sends the attribute batches of every prepared analysis through one shared thread pool
+    and returns the results per analysis, in template order. An analysis with a failed
+    batch gets that batch's exception instead, so the other analyses are unaffected.
+    """
+    batch_results = [[None] * len(analysis["batches"]) for analysis in analyses]
+    errors = [None] * len(analyses)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {
+            executor.submit(_analyze_attribute_batch, batch, sop_blocks): (i, j)
+            for i, analysis in enumerate(analyses)
+            for j, (batch, sop_blocks) in enumerate(analysis["batches"])
+        }
+        for future in as_completed(futures):
+            i, j = futures[future]
+            try:
+                batch_results[i][j] = future.result()
+            except Exception as e:
+                logger.error(f"Analysis of {analyses[i]['source_sop_file']} failed: {str(e)}", exc_info=True)
+                errors[i] = errors[i] or e
+    return [
+        error or [result for results in batches for result in results]
+        for error, batches in zip(errors, batch_results)
+    ]
+
+
+def _save_analysis(analysis, analysis_results):
+    """Saves the analysis results to S3 and returns the location of the new file."""
+    output_key = analysis["output_key"]
+    output_data = {
+        "source_sop_file": analysis["source_sop_file"],
+        "analysis_timestamp": datetime.now().isoformat(),
+        "results": analysis_results
+    }
+    
+    s3_client.put_object(
+        Bucket=OUTPUT_BUCKET,
+        Key=output_key,
+        Body=json.dumps(output_data, indent=2) if DEBUG_JSON else json.dumps(output_data, separators=(',', ':')),
+        ContentType='application/json'
+    )
+    logger.info(f"Successfully saved analysis results to s3://{OUTPUT_BUCKET}/{output_key}")
+    
+    return {
+        "s3_bucket": OUTPUT_BUCKET,
+        "s3_key": output_key
+    }
+
+
+def _handle_sqs_batch(records):
+    """
+    Analyzes every SOP in an SQS batch at once, interleaving all of their Bedrock calls
+    in one thread pool. Failed messages are reported back as partial batch failures.
+    """
+    analyses = []
+    message_ids = []
+    failures = []
+    for record in records:
+        try:
+            message = json.loads(record['body'])
+            analyses.append(_prepare_analysis(message['structured_sop_input'], message['de_template_input']))
+            message_ids.append(record['messageId'])
+        except Exception as e:
+            logger.error(f"Could not prepare message {record.get('messageId')}: {str(e)}", exc_info=True)
+            failures.append({"itemIdentifier": record.get('messageId')})
+
+    for message_id, analysis, analysis_results in zip(message_ids, analyses, _run_analyses(analyses)):
+        if isinstance(analysis_results, Exception):
+            failures.append({"itemIdentifier": message_id})
+            continue
+        try:
+            _save_analysis(analysis, analysis_results)
+        except Exception as e:
+            logger.error(f"Could not save results for message {message_id}: {str(e)}", exc_info=True)
+            failures.append({"itemIdentifier": message_id})
+
+    return {"batchItemFailures": failures}
+
 
 # --- UPDATED LAMBDA HANDLER SECTION ---
 # This handler is designed to work correctly within the Step Function.
@@ -45,137 +451,29 @@ def lambda_handler(event, context):
     """
     Receives S3 locations for the structured SOP and the DE template,
     runs analysis using Claude, saves the result, and returns the S3 location of that result.
+    An SQS event carrying several such requests is processed as one batch.
     """
-    output_bucket_name = 'de-processing-bucket'
-    
+    if "Records" in event:
+        return _handle_sqs_batch(event['Records'])
+
     try:
         # Step 1: Get input file locations from the Step Function event.
         # THIS IS THE UPDATED SECTION that correctly parses the input from the Parallel step.
         # Instead of 'sop_file_key', it now looks for 'structured_sop_input'.
         sop_input = event['structured_sop_input']
         template_input = event['de_template_input']
-        
-        sop_bucket = sop_input['s3_bucket']
-        sop_key = sop_input['s3_key']
-        
-        template_bucket = template_input['s3_bucket']
-        template_key = template_input['s3_key']
 
-        logger.info(f"Processing SOP: s3://{sop_bucket}/{sop_key}")
-        logger.info(f"Using Template: s3://{template_bucket}/{template_key}")
+        # Step 2: Load the inputs from S3 and prepare the attribute batches.
+        analysis = _prepare_analysis(sop_input, template_input)
 
-        # Step 2: Define the output file location. This logic is adapted from your original code.
-        sop_base_filename = os.path.splitext(os.path.basename(sop_key))[0]
-        if sop_base_filename.endswith('_processed'):
-            sop_base_filename = sop_base_filename.replace('_processed', '')
-        
-        output_filename = f"{sop_base_filename}_claude_analysis.json"
-        output_key = f"analysis_results/{output_filename}"
-
-        # Step 3: Retrieve and load the input files from S3.
-        sop_response = s3_client.get_object(Bucket=sop_bucket, Key=sop_key)
-        sop_data = json.loads(sop_response['Body'].read().decode('utf-8'))
-        
-        template_response = s3_client.get_object(Bucket=template_bucket, Key=template_key)
-        de_template = json.loads(template_response['Body'].read().decode('utf-8'))
-        
-        # --- Your core analysis logic begins here. No changes have been made to this section. ---
-        if isinstance(de_template, dict):
-            de_template = [de_template]
-            
-        analysis_results = []
-        sop_text_for_prompt = json.dumps(sop_data, indent=2)
-
-        for i, template_item in enumerate(de_template):
-            try:
-                if i > 0:
-                    time.sleep(3) # Your original delay
-                
-                attribute = template_item.get('Attribute', 'Unknown')
-                required_question = template_item.get('Required Questions', '')
-                considerations = template_item.get('Considerations', '')
-                
-                logger.info(f"Analyzing attribute '{attribute}'. Sending {len(sop_text_for_prompt)} characters to the model.")
-                
-                prompt = f"""Analyze this SOP for "{attribute}".
-
-SOP: {sop_text_for_prompt}
-
-Question: {required_question}
-Considerations: {considerations}
-
-Respond in JSON:
-{{
-  "required_answer": "answer",
-  "consideration_answers": ["answer1", "answer2"],
-  "evidence": [{{"section": "name", "relevance": "why"}}],
-  "comment": "summary"
-}}"""
-                
-                body = {
-                    "anthropic_version": "bedrock-2023-05-31",
-                    "max_tokens": 5000,
-                    "messages": [{"role": "user", "content": prompt}]
-                }
-                
-                response = invoke_model_with_retry(
-                    bedrock_client, 
-                    "anthropic.claude-3-sonnet-20240229-v1:0", 
-                    body
-                )
-                
-                response_body = json.loads(response['body'].read())
-                claude_text = response_body['content'][0]['text']
-                
-                try:
-                    start = claude_text.find('{')
-                    end = claude_text.rfind('}') + 1
-                    claude_json = json.loads(claude_text[start:end]) if start != -1 and end != -1 else {"comment": "No JSON object found in model response."}
-                except Exception:
-                    claude_json = { "comment": "Could not parse valid JSON from model response." }
-                
-                result = {
-                    "Attribute": attribute,
-                    "Required Question": required_question,
-                    "Considerations": considerations.split('\n') if considerations else [],
-                    "Answers": claude_json.get('required_answer', ''),
-                    "Evidence": claude_json.get('evidence', []),
-                    "Comment": claude_json.get('comment', '')
-                }
-                analysis_results.append(result)
-                logger.info(f"Successfully processed attribute: {attribute}")
-            
-            except Exception as e:
-                logger.error(f"Error processing attribute '{attribute}': {str(e)}")
-                analysis_results.append({
-                    "Attribute": template_item.get('Attribute', 'Unknown'),
-                    "Answers": f"Error: {str(e)}",
-                    "Comment": f"Processing failed for this attribute: {str(e)}"
-                })
-        
-        # --- End of your core analysis logic ---
+        # Step 3: Run the Claude analysis for every attribute.
+        analysis_results = _run_analyses([analysis])[0]
+        if isinstance(analysis_results, Exception):
+            raise analysis_results
 
         # Step 4: Save the final results to S3.
-        # This section is adapted from your original code.
-        output_data = {
-            "source_sop_file": f"s3://{sop_bucket}/{sop_key}",
-            "analysis_timestamp": datetime.now().isoformat(),
-            "results": analysis_results
-        }
-        
-        s3_client.put_object(
-            Bucket=output_bucket_name,
-            Key=output_key,
-            Body=json.dumps(output_data, indent=2),
-            ContentType='application/json'
-        )
-        logger.info(f"Successfully saved analysis results to s3://{output_bucket_name}/{output_key}")
-        
         # Step 5: Return ONLY the location of the new file for the final step.
-        return {
-            "s3_bucket": output_bucket_name,
-            "s3_key": output_key
-        }
+        return _save_analysis(analysis, analysis_results)
 
     except Exception as e:
         logger.error(f"A critical error occurred in the Lambda handler: {str(e)}", exc_info=True)
@@ -195,4 +493,14 @@ Lambda Test Event
     "s3_key": "DE_Templates/Control_Testing_Template.json"
   }
 }
+
+SQS Batch Test Event (each message body is one of the events above)
+{
+  "Records": [
+    {
+      "messageId": "1",
+      "body": "{\"structured_sop_input\": {\"s3_bucket\": \"de-processing-bucket\", \"s3_key\": \"processed-sop/TEST SoP MR_processed.json\"}, \"de_template_input\": {\"s3_bucket\": \"de-processing-bucket\", \"s3_key\": \"DE_Templates/Control_Testing_Template.json\"}}"
+    }
+  ]
+}
 """
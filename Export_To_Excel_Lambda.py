@@ -1,18 +1,70 @@
 import json
 import boto3
-import pandas as pd
 import io
 import os
+import re
 import traceback
+import zipfile
+from botocore.config import Config
+from xml.sax.saxutils import escape
 
-# Initialize the S3 client
-s3_client = boto3.client('s3')
+# Initialize the S3 client once per container, with adaptive retries and keep-alive connections
+client_config = Config(
+    retries={'max_attempts': 5, 'mode': 'adaptive'},
+    max_pool_connections=20,
+    tcp_keepalive=True
+)
+s3_client = boto3.client('s3', config=client_config)
 
 # Define the target bucket for the output Excel file
 TARGET_BUCKET = os.environ.get('TARGET_BUCKET', 'sop-output-bucket')
 
+SHEET_NAME = 'Analysis Results'
+MAX_COLUMN_WIDTH = 70
+# Excel rejects cells longer than this.
+MAX_CELL_LENGTH = 32767
+# Control characters that are not allowed anywhere in an XML document.
+ILLEGAL_XML_CHARS = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
 
-# --- NO CHANGES TO YOUR CORE LOGIC FUNCTIONS BELOW ---
+# --- Static parts of a single-sheet .xlsx package (SpreadsheetML) ---
+XLSX_CONTENT_TYPES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>
+<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>
+<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>
+</Types>"""
+
+XLSX_ROOT_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>
+</Relationships>"""
+
+XLSX_WORKBOOK = f"""<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">
+<sheets><sheet name="{SHEET_NAME}" sheetId="1" r:id="rId1"/></sheets>
+</workbook>"""
+
+XLSX_WORKBOOK_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>
+<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>
+</Relationships>"""
+
+# Style 0 is the default cell; style 1 is the bold, bordered, centered header pandas used to write.
+XLSX_STYLES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">
+<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font><font><b/><sz val="11"/><name val="Calibri"/></font></fonts>
+<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>
+<borders count="2"><border><left/><right/><top/><bottom/><diagonal/></border><border><left style="thin"/><right style="thin"/><top style="thin"/><bottom style="thin"/><diagonal/></border></borders>
+<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>
+<cellXfs count="2"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/><xf numFmtId="0" fontId="1" fillId="0" borderId="1" xfId="0" applyFont="1" applyBorder="1" applyAlignment="1"><alignment horizontal="center" vertical="top"/></xf></cellXfs>
+<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>
+</styleSheet>"""
+
+
+# --- Core Logic Functions ---
 
 def format_list_column(data):
     """
@@ -22,21 +74,104 @@ def format_list_column(data):
     if not isinstance(data, list):
         return data
 
-    # Handle the 'Evidence' list of dictionaries
-    if data and isinstance(data[0], dict):
-        formatted_items = []
-        for item in data:
-            # Assuming 'section' and 'relevance' keys exist
-            section = item.get('section', 'N/A')
-            relevance = item.get('relevance', 'N/A')
-            formatted_items.append(f"Section: {section}\nRelevance: {relevance}")
-        return "\n---\n".join(formatted_items)
-    
-    # Handle a simple list of strings (like 'Considerations')
-    elif data and isinstance(data[0], str):
-        return "\n".join(f"- {item}" for item in data)
-        
-    return ""
+    # Dispatch on the type of the first item: a list of dicts is 'Evidence',
+    # a simple list of strings is 'Considerations'. The data comes from json.load,
+    # so the items are plain dicts and strs.
+    formatter = LIST_FORMATTERS.get(type(data[0])) if data else None
+    if formatter is None:
+        return ""
+    return formatter(data)
+
+
+def format_evidence_list(data):
+    """Formats a list of evidence dicts as 'Section'/'Relevance' blocks separated by '---'."""
+    # Assuming 'section' and 'relevance' keys exist
+    return "\n---\n".join(
+        f"Section: {item.get('section', 'N/A')}\nRelevance: {item.get('relevance', 'N/A')}"
+        for item in data
+    )
+
+
+def format_string_list(data):
+    """Formats a list of strings as one bullet per line."""
+    return "\n".join(map("- {}".format, data))
+
+
+LIST_FORMATTERS = {dict: format_evidence_list, str: format_string_list}
+
+
+def column_letter(index):
+    """Converts a zero-based column index to its Excel letter (0 -> A, 26 -> AA)."""
+    letters = ""
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+def cell_xml(ref, value, style=0):
+    """Renders one <c> element. Text is written as an inline string, so no shared-strings table is needed."""
+    style_attr = f' s="{style}"' if style else ''
+    if isinstance(value, bool):
+        return f'<c r="{ref}"{style_attr} t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float)):
+        return f'<c r="{ref}"{style_attr}><v>{value!r}</v></c>'
+    text = ILLEGAL_XML_CHARS.sub("", str(value))[:MAX_CELL_LENGTH]
+    return f'<c r="{ref}"{style_attr} t="inlineStr"><is><t xml:space="preserve">{escape(text)}</t></is></c>'
+
+
+def is_blank(value):
+    """True for values that are left as empty cells (missing keys, None, NaN, empty strings)."""
+    return value is None or value == "" or (isinstance(value, float) and value != value)
+
+
+def sheet_rows_xml(columns, rows):
+    """Yields the worksheet's <row> elements one at a time: the header row, then one row per result."""
+    letters = [column_letter(i) for i in range(len(columns))]
+    yield '<row r="1">' + "".join(cell_xml(f"{letter}1", column, style=1) for letter, column in zip(letters, columns)) + '</row>'
+    for row_number, row in enumerate(rows, start=2):
+        cells = "".join(
+            cell_xml(f"{letter}{row_number}", value)
+            for letter, value in zip(letters, row) if not is_blank(value)
+        )
+        yield f'<row r="{row_number}">{cells}</row>'
+
+
+def build_xlsx(results_data, output_buffer):
+    """
+    Writes the results (a list of dicts) as a single-sheet .xlsx file into output_buffer.
+    Columns follow first-seen key order across the results, as a DataFrame built from them would.
+    """
+    columns = list(dict.fromkeys(key for result in results_data for key in result))
+    rows = [[result.get(column) for column in columns] for result in results_data]
+
+    # Column widths: longest value or header + 2, capped.
+    widths = [len(str(column)) for column in columns]
+    for row in rows:
+        for i, value in enumerate(row):
+            if not is_blank(value):
+                widths[i] = max(widths[i], len(str(value)))
+    cols_xml = "".join(
+        f'<col min="{i}" max="{i}" width="{min(width + 2, MAX_COLUMN_WIDTH)}" customWidth="1"/>'
+        for i, width in enumerate(widths, start=1)
+    )
+
+    with zipfile.ZipFile(output_buffer, 'w', zipfile.ZIP_DEFLATED) as xlsx:
+        xlsx.writestr('[Content_Types].xml', XLSX_CONTENT_TYPES)
+        xlsx.writestr('_rels/.rels', XLSX_ROOT_RELS)
+        xlsx.writestr('xl/workbook.xml', XLSX_WORKBOOK)
+        xlsx.writestr('xl/_rels/workbook.xml.rels', XLSX_WORKBOOK_RELS)
+        xlsx.writestr('xl/styles.xml', XLSX_STYLES)
+        with xlsx.open('xl/worksheets/sheet1.xml', 'w') as sheet:
+            sheet.write(
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                f'<cols>{cols_xml}</cols><sheetData>'.encode('utf-8')
+            )
+            for row_xml in sheet_rows_xml(columns, rows):
+                sheet.write(row_xml.encode('utf-8'))
+            sheet.write(b'</sheetData></worksheet>')
 
 
 # --- UPDATED LAMBDA HANDLER SECTION ---
@@ -61,22 +196,24 @@ def lambda_handler(event, context):
 
     try:
         # 2. Read the JSON file from the source S3 bucket
+        # json.load parses the raw bytes, so no intermediate decoded copy is made.
         response = s3_client.get_object(Bucket=source_bucket, Key=source_key)
-        json_content = response['Body'].read().decode('utf-8')
-        data = json.loads(json_content)
+        data = json.load(response['Body'])
 
-        # 3. Extract the 'results' array and convert it to a Pandas DataFrame
+        # 3. Extract the 'results' array
         results_data = data.get('results', [])
         if not results_data:
             raise ValueError("JSON data does not contain a 'results' key or the key is empty.")
-            
-        df = pd.DataFrame(results_data)
         
-        # Format list-based columns for better readability in Excel
-        if 'Evidence' in df.columns:
-            df['Evidence'] = df['Evidence'].apply(format_list_column)
-        if 'Considerations' in df.columns:
-            df['Considerations'] = df['Considerations'].apply(format_list_column)
+        # Format list-based columns for better readability in Excel.
+        # Considerations are always a list of strings (written by the analysis Lambda);
+        # Evidence comes from the model, so its shape is checked per row.
+        for result in results_data:
+            if 'Evidence' in result:
+                result['Evidence'] = format_list_column(result['Evidence'])
+            considerations = result.get('Considerations')
+            if isinstance(considerations, list):
+                result['Considerations'] = format_string_list(considerations)
 
         # 4. Determine the output filename based on the source file key
         # (This logic from your original code is slightly improved)
@@ -85,34 +222,22 @@ def lambda_handler(event, context):
         output_filename = f"{sop_name}_Final_Analysis.xlsx"
         output_key = f"excel_outputs/{output_filename}" # Store in a sub-folder
 
-        # 5. Create the Excel file in-memory
+        # 5. Create the Excel file in-memory. The sheet XML is streamed straight into the
+        # zip package, without a DataFrame or per-cell workbook objects.
         with io.BytesIO() as output_buffer:
-            # Use a writer to set column widths for better readability
-            with pd.ExcelWriter(output_buffer, engine='openpyxl') as writer:
-                df.to_excel(writer, index=False, sheet_name='Analysis Results')
-                # Auto-adjust column widths
-                worksheet = writer.sheets['Analysis Results']
-                for column in worksheet.columns:
-                    max_length = 0
-                    column_letter = column[0].column_letter
-                    for cell in column:
-                        try:
-                            if cell.value:
-                                max_length = max(len(str(cell.value)), max_length)
-                        except:
-                            pass
-                    adjusted_width = (max_length + 2)
-                    worksheet.column_dimensions[column_letter].width = min(adjusted_width, 70) # Cap width at 70
-
-            excel_data = output_buffer.getvalue()
-
-        # 6. Upload the Excel file to the target S3 bucket
-        s3_client.put_object(
-            Bucket=TARGET_BUCKET,
-            Key=output_key,
-            Body=excel_data,
-            ContentType='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        )
+            build_xlsx(results_data, output_buffer)
+
+            # 6. Upload the Excel file to the target S3 bucket.
+            # The buffer itself is passed as the body, so the file is not copied into a new bytes object.
+            # CRC32 is checksummed with zlib's native implementation; CRC32C would need the CRT extra.
+            output_buffer.seek(0)
+            s3_client.put_object(
+                Bucket=TARGET_BUCKET,
+                Key=output_key,
+                Body=output_buffer,
+                ChecksumAlgorithm='CRC32',
+                ContentType='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+            )
         
         final_report_location = f"s3://{TARGET_BUCKET}/{output_key}"
         print(f"Workflow complete. Final report available at: {final_report_location}")
@@ -3,8 +3,15 @@ import openpyxl
 import io
 import json
 import os
+from botocore.config import Config
 
-s3_client = boto3.client('s3')
+# Created once per container and reused across warm invocations.
+client_config = Config(
+    retries={'max_attempts': 5, 'mode': 'adaptive'},
+    max_pool_connections=20,
+    tcp_keepalive=True
+)
+s3_client = boto3.client('s3', config=client_config)
 
 def lambda_handler(event, context):
     """
@@ -33,40 +40,59 @@ def lambda_handler(event, context):
         # Step 3: Read the Excel file from S3.
         response = s3_client.get_object(Bucket=input_bucket, Key=input_key)
         file_stream = io.BytesIO(response['Body'].read())
-        wb = openpyxl.load_workbook(file_stream, data_only=True)
+        # read_only streams the sheet's rows instead of building every cell (with styles) in memory.
+        wb = openpyxl.load_workbook(file_stream, data_only=True, read_only=True)
+        try:
+            if "DE Template" not in wb.sheetnames:
+                raise ValueError("Sheet named 'DE Template' not found in the workbook.")
 
-        if "DE Template" not in wb.sheetnames:
-            raise ValueError("Sheet named 'DE Template' not found in the workbook.")
+            sheet = wb["DE Template"]
+            # Read-only iteration trusts the sheet's stored <dimension>, which some tools write stale;
+            # resetting it makes every row be read to its real length.
+            sheet.reset_dimensions()
 
-        sheet = wb["DE Template"]
+            # Steps 4 and 5: Locate the header row, then extract the data under it (your original logic).
+            # Both happen in one pass over the rows, so the sheet is only parsed once.
+            expected_headers = ["Attribute", "Required Questions", "Considerations"]
+            headers = None
+            data = []
+            strip = str.strip
+            data_append = data.append
+            for row in sheet.iter_rows(values_only=True):
+                if headers is None:
+                    if row is None: continue
+                    cleaned_row = [strip(str(cell)) if cell else "" for cell in row]
+                    if all(header in cleaned_row for header in expected_headers):
+                        headers = cleaned_row
+                        # A repeated header name maps to its last column, as dict(zip(headers, row)) did.
+                        last_column = {header: idx for idx, header in enumerate(cleaned_row)}
+                        attribute_idx, questions_idx, considerations_idx = (
+                            last_column[header] for header in expected_headers
+                        )
+                        row_width = max(attribute_idx, questions_idx, considerations_idx) + 1
+                    continue
 
-        # Step 4: Locate the header row (your original logic).
-        expected_headers = ["Attribute", "Required Questions", "Considerations"]
-        header_row_idx = None
-        headers = []
-        for i, row in enumerate(sheet.iter_rows(values_only=True), start=1):
-            if row is None: continue
-            cleaned_row = [str(cell).strip() if cell else "" for cell in row]
-            if all(header in cleaned_row for header in expected_headers):
-                header_row_idx = i
-                headers = cleaned_row
-                break
-        
-        if header_row_idx is None:
-            raise ValueError("Required headers ('Attribute', 'Required Questions', 'Considerations') not found.")
+                # Rows are read by column position; short rows are padded so trailing empty cells read as None.
+                if not row: continue
+                if len(row) < row_width:
+                    row = tuple(row) + (None,) * (row_width - len(row))
+                attribute = row[attribute_idx]
+                if attribute is None: continue
+                attribute = strip(str(attribute))
+                if not attribute: continue
+                questions = row[questions_idx]
+                considerations = row[considerations_idx]
+                data_append({
+                    "Attribute": attribute,
+                    "Required Questions": "" if questions is None else strip(str(questions)),
+                    "Considerations": "" if considerations is None else strip(str(considerations))
+                })
 
-        # Step 5: Extract data under the headers (your original logic).
-        data = []
-        for row in sheet.iter_rows(min_row=header_row_idx + 1, values_only=True):
-            if not row or all(cell is None or str(cell).strip() == "" for cell in row): continue
-            row_dict = dict(zip(headers, row))
-            extracted_row = {
-                "Attribute": str(row_dict.get("Attribute", "")).strip(),
-                "Required Questions": str(row_dict.get("Required Questions", "")).strip(),
-                "Considerations": str(row_dict.get("Considerations", "")).strip()
-            }
-            if extracted_row["Attribute"]:
-                data.append(extracted_row)
+            if headers is None:
+                raise ValueError("Required headers ('Attribute', 'Required Questions', 'Considerations') not found.")
+        finally:
+            # A read-only workbook keeps its archive open until closed.
+            wb.close()
 
         # Step 6: Prepare the output path and save the JSON result to S3.
         output_bucket = "de-processing-bucket"
@@ -76,7 +102,7 @@ def lambda_handler(event, context):
         s3_client.put_object(
             Bucket=output_bucket,
             Key=output_key,
-            Body=json.dumps(data, indent=2),
+            Body=json.dumps(data, separators=(",", ":")),
             ContentType="application/json"
         )
         print(f"Successfully extracted template data to: s3://{output_bucket}/{output_key}")
@@ -1,26 +1,69 @@
 import boto3
+import io
 import time
 import json
+import os
+import random
 import re
 import traceback
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
 
 # --- Configuration ---
 # Define the bucket where intermediate processed files will be stored
 PROCESSING_BUCKET = "de-processing-bucket"
 
-# Initialize AWS clients once
-textract = boto3.client("textract")
-s3_client = boto3.client("s3")
+# Textract job polling: first delay and the cap for the exponential backoff (seconds)
+POLL_INITIAL_DELAY = 0.5
+POLL_MAX_DELAY = 10.0
+
+# When set, Textract writes its results under this prefix in PROCESSING_BUCKET and they are
+# read back from S3, instead of being paged through GetDocumentAnalysis.
+TEXTRACT_OUTPUT_PREFIX = os.environ.get("TEXTRACT_OUTPUT_PREFIX", "").strip("/")
+
+# Resolution of the per-page grid used to find the tables around a LINE (cells per axis)
+TABLE_GRID_SIZE = 10
+# Pages with fewer tables than this are scanned directly; bucketing them costs more than it saves
+TABLE_GRID_MIN_TABLES = 4
+
+# Two or more consecutive whitespace characters separate the columns of a fallback table line
+MULTI_WHITESPACE = re.compile(r"\s{2,}")
+
+# Block types a TABLE's cells are built from; all other blocks are dropped once read
+TABLE_CHILD_BLOCK_TYPES = frozenset({"CELL", "WORD", "SELECTION_ELEMENT"})
+
+# Initialize AWS clients once. Keep-alive connections are reused across the
+# polling and pagination calls and across warm invocations.
+client_config = Config(
+    retries={'max_attempts': 5, 'mode': 'adaptive'},
+    max_pool_connections=20,
+    tcp_keepalive=True
+)
+textract = boto3.client("textract", config=client_config)
+s3_client = boto3.client("s3", config=client_config)
+
+# Large extraction results are uploaded in 8 MB parts
+UPLOAD_TRANSFER_CONFIG = TransferConfig(multipart_threshold=8 * 1024 * 1024)
 
 def start_textract_job(bucket, key):
+    extra_args = {}
+    if TEXTRACT_OUTPUT_PREFIX:
+        extra_args["OutputConfig"] = {"S3Bucket": PROCESSING_BUCKET, "S3Prefix": TEXTRACT_OUTPUT_PREFIX}
+
     response = textract.start_document_analysis(
         DocumentLocation={"S3Object": {"Bucket": bucket, "Name": key}},
-        FeatureTypes=["TABLES", "FORMS"]
+        FeatureTypes=["TABLES", "FORMS"],
+        **extra_args
     )
     return response["JobId"]
 
 
 def is_job_complete(job_id):
+    # Poll quickly at first so short jobs return early, then back off (with jitter)
+    # so long jobs do not spend the GetDocumentAnalysis quota.
+    delay = POLL_INITIAL_DELAY
     while True:
         response = textract.get_document_analysis(JobId=job_id)
         status = response["JobStatus"]
@@ -28,28 +71,83 @@ def is_job_complete(job_id):
             if status == "FAILED":
                 print(f"Textract job failed: {response.get('StatusMessage')}")
             return status == "SUCCEEDED"
-        time.sleep(2)
+        time.sleep(delay + random.uniform(0, delay * 0.1))
+        delay = min(delay * 1.7, POLL_MAX_DELAY)
 
 
-def get_all_textract_blocks(job_id):
-    all_blocks = []
-    next_token = None
-    while True:
-        if next_token:
-            response = textract.get_document_analysis(JobId=job_id, NextToken=next_token)
-        else:
-            response = textract.get_document_analysis(JobId=job_id)
-        
-        all_blocks.extend(response.get("Blocks", []))
-        next_token = response.get("NextToken")
-        
-        if not next_token:
-            break
-            
-    return all_blocks
+def iter_textract_pages(job_id):
+    # Yields the blocks of each GetDocumentAnalysis page. As soon as a page arrives,
+    # the next one is requested on a background thread, so the round trip overlaps
+    # with whatever the caller does with the current page.
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        response = textract.get_document_analysis(JobId=job_id)
+        while True:
+            next_token = response.get("NextToken")
+            next_page = None
+            if next_token:
+                next_page = prefetcher.submit(textract.get_document_analysis, JobId=job_id, NextToken=next_token)
+
+            yield response.get("Blocks", [])
+
+            if next_page is None:
+                break
+            response = next_page.result()
+
+
+def iter_textract_output_pages(job_id):
+    # Yields the blocks of each result file Textract wrote for the job through OutputConfig.
+    # The files are named <prefix>/<JobId>/1, 2, ...; other objects (such as the
+    # .s3_access_check marker) are skipped. Every object under the job's prefix is
+    # deleted once the pages have been read, so results do not pile up in the bucket.
+    job_prefix = f"{TEXTRACT_OUTPUT_PREFIX}/{job_id}/"
+    job_keys = []
+    page_keys = []
+    for listing in s3_client.get_paginator("list_objects_v2").paginate(Bucket=PROCESSING_BUCKET, Prefix=job_prefix):
+        for obj in listing.get("Contents", ()):
+            job_keys.append(obj["Key"])
+            name = obj["Key"][len(job_prefix):]
+            if name.isdigit():
+                page_keys.append((int(name), obj["Key"]))
+
+    try:
+        for _, page_key in sorted(page_keys):
+            response = s3_client.get_object(Bucket=PROCESSING_BUCKET, Key=page_key)
+            yield json.load(response["Body"]).get("Blocks", [])
+    finally:
+        # DeleteObjects accepts at most 1000 keys per request.
+        for i in range(0, len(job_keys), 1000):
+            s3_client.delete_objects(
+                Bucket=PROCESSING_BUCKET,
+                Delete={"Objects": [{"Key": key} for key in job_keys[i:i + 1000]], "Quiet": True}
+            )
 
 
-def is_block_inside_tables(line_block, table_geometries):
+def get_textract_pages(job_id):
+    if TEXTRACT_OUTPUT_PREFIX:
+        return iter_textract_output_pages(job_id)
+    return iter_textract_pages(job_id)
+
+
+def _grid_index(value):
+    return min(max(int(value * TABLE_GRID_SIZE), 0), TABLE_GRID_SIZE)
+
+
+def build_table_grid(table_geometries):
+    # Buckets a page's table bounding boxes into a coarse grid over the (normalized) page,
+    # adding each box to every grid cell it overlaps.
+    grid = {}
+    for table_box in table_geometries:
+        x_start = _grid_index(table_box['Left'])
+        x_end = _grid_index(table_box['Left'] + table_box['Width'])
+        y_start = _grid_index(table_box['Top'])
+        y_end = _grid_index(table_box['Top'] + table_box['Height'])
+        for grid_x in range(x_start, x_end + 1):
+            for grid_y in range(y_start, y_end + 1):
+                grid.setdefault((grid_x, grid_y), []).append(table_box)
+    return grid
+
+
+def is_block_inside_tables(line_block, table_geometries, table_grid=None):
     line_box = line_block.get('Geometry', {}).get('BoundingBox')
     if not line_box:
         return False
@@ -57,96 +155,136 @@ def is_block_inside_tables(line_block, table_geometries):
     line_center_x = line_box['Left'] + line_box['Width'] / 2
     line_center_y = line_box['Top'] + line_box['Height'] / 2
 
-    for table_box in table_geometries:
+    # With a grid, only the tables overlapping the grid cell of the line's center can contain it.
+    candidates = table_geometries
+    if table_grid is not None:
+        candidates = table_grid.get((_grid_index(line_center_x), _grid_index(line_center_y)), ())
+
+    for table_box in candidates:
         if (table_box['Left'] <= line_center_x <= table_box['Left'] + table_box['Width'] and
             table_box['Top'] <= line_center_y <= table_box['Top'] + table_box['Height']):
             return True
     return False
 
 
-def extract_text_and_tables(blocks):
+def extract_table_rows(table_block, block_map):
+    # Resolves a TABLE block's CELL children into rows of cell text, ordered by row and column.
+    get_block = block_map.get
+    cells = []
+    for relationship in table_block.get("Relationships") or ():
+        if relationship["Type"] != "CHILD":
+            continue
+        for cell_id in relationship["Ids"]:
+            cell = get_block(cell_id)
+            if not cell or cell["BlockType"] != "CELL":
+                continue
+
+            row_index = cell["RowIndex"]
+            col_index = cell["ColumnIndex"]
+            parts = []
+            part_append = parts.append
+
+            for child_rel in cell.get("Relationships") or ():
+                if child_rel["Type"] == "CHILD":
+                    for child_id in child_rel["Ids"]:
+                        word = get_block(child_id)
+                        if word:
+                            if word["BlockType"] == "WORD":
+                                part_append(word["Text"])
+                                part_append(" ")
+                            elif word["BlockType"] == "SELECTION_ELEMENT":
+                                selected = word.get("SelectionStatus") == "SELECTED"
+                                part_append("[X] " if selected else "[ ] ")
+
+            cells.append((row_index, col_index, "".join(parts).strip()))
+
+    # One sort orders the cells by row, then column; rows are split off where the row index changes.
+    # The sort is stable, so if a position repeats, the cell listed last wins.
+    cells.sort(key=itemgetter(0, 1))
+    sorted_rows = []
+    current_row = current_col = None
+    for row_index, col_index, text in cells:
+        if row_index != current_row:
+            row = []
+            sorted_rows.append(row)
+            current_row = row_index
+        elif col_index == current_col:
+            row[-1] = text
+            continue
+        row.append(text)
+        current_col = col_index
+    return sorted_rows
+
+
+def extract_text_and_tables(pages):
+    # Consumes the Textract result one page of blocks at a time, so the full block list
+    # is never built. Only the blocks a table's cells can reference are kept in block_map.
     raw_text_lines = []
     tables = []
-    table_geometries = []
+    table_geometries = {}
     page_line_blocks = {}
-
-    block_map = {block["Id"]: block for block in blocks}
-
-    for block in blocks:
-        if block["BlockType"] == "LINE":
-            raw_text_lines.append(block["Text"])
-            page_number = block.get("Page", 1)
-            page_line_blocks.setdefault(page_number, []).append(block)
-
-        elif block["BlockType"] == "TABLE":
-            if 'Geometry' in block and 'BoundingBox' in block['Geometry']:
-                table_geometries.append(block['Geometry']['BoundingBox'])
-
-            cells_by_row = {}
-            for relationship in block.get("Relationships", []):
-                if relationship["Type"] == "CHILD":
-                    for cell_id in relationship["Ids"]:
-                        cell = block_map.get(cell_id)
-                        if not cell or cell["BlockType"] != "CELL":
-                            continue
-
-                        row_index = cell["RowIndex"]
-                        col_index = cell["ColumnIndex"]
-                        text = ""
-                        
-                        if "Relationships" in cell:
-                            for child_rel in cell.get("Relationships", []):
-                                if child_rel["Type"] == "CHILD":
-                                    for child_id in child_rel["Ids"]:
-                                        word = block_map.get(child_id)
-                                        if word:
-                                            if word["BlockType"] == "WORD":
-                                                text += word["Text"] + " "
-                                            elif word["BlockType"] == "SELECTION_ELEMENT":
-                                                selected = word.get("SelectionStatus") == "SELECTED"
-                                                text += "[X] " if selected else "[ ] "
-                        
-                        cells_by_row.setdefault(row_index, {})[col_index] = text.strip()
-
-            sorted_rows = []
-            for row_index in sorted(cells_by_row.keys()):
-                row = []
-                col_map = cells_by_row[row_index]
-                for col_index in sorted(col_map.keys()):
-                    row.append(col_map[col_index])
-                sorted_rows.append(row)
-
-            tables.append({
-                "page": block.get("Page", 1),
-                "source": "TEXTRACT_TABLE",
-                "rows": sorted_rows
-            })
+    table_blocks = []
+    block_map = {}
+
+    # One pass over all blocks picks out LINEs and TABLEs and indexes cell content by Id.
+    # Cells are resolved afterwards, touching only the children of TABLE blocks.
+    line_append = raw_text_lines.append
+    table_append = table_blocks.append
+    for page_blocks in pages:
+        for block in page_blocks:
+            block_type = block["BlockType"]
+            if block_type == "LINE":
+                line_append(block["Text"])
+                page_number = block.get("Page", 1)
+                page_lines = page_line_blocks.get(page_number)
+                if page_lines is None:
+                    page_lines = page_line_blocks[page_number] = []
+                page_lines.append(block)
+            elif block_type == "TABLE":
+                table_append(block)
+            elif block_type in TABLE_CHILD_BLOCK_TYPES:
+                block_map[block["Id"]] = block
+
+    for block in table_blocks:
+        if 'Geometry' in block and 'BoundingBox' in block['Geometry']:
+            table_geometries.setdefault(block.get("Page", 1), []).append(block['Geometry']['BoundingBox'])
+
+        tables.append({
+            "page": block.get("Page", 1),
+            "source": "TEXTRACT_TABLE",
+            "rows": extract_table_rows(block, block_map)
+        })
 
     for page_num, line_blocks in page_line_blocks.items():
+        page_tables = table_geometries.get(page_num, ())
+        table_grid = build_table_grid(page_tables) if len(page_tables) >= TABLE_GRID_MIN_TABLES else None
+        has_columns = MULTI_WHITESPACE.search
+        split_columns = MULTI_WHITESPACE.split
         buffer = []
         for line_block in line_blocks:
-            if is_block_inside_tables(line_block, table_geometries):
+            if is_block_inside_tables(line_block, page_tables, table_grid):
                 continue
             
+            # The buffer holds each matching line already split into its columns,
+            # so a flushed table needs no second regex pass.
             line_text = line_block["Text"]
-            if re.search(r"\s{2,}", line_text):
-                buffer.append(line_text)
+            if has_columns(line_text):
+                buffer.append(split_columns(line_text.strip()))
             else:
                 if len(buffer) >= 2:
-                    parsed_rows = [re.split(r"\s{2,}", l.strip()) for l in buffer]
                     tables.append({
                         "page": page_num,
                         "source": "FALLBACK_REGEX",
-                        "rows": parsed_rows
+                        "rows": buffer
                     })
-                buffer = []
+                if buffer:
+                    buffer = []
 
         if len(buffer) >= 2:
-            parsed_rows = [re.split(r"\s{2,}", l.strip()) for l in buffer]
             tables.append({
                 "page": page_num,
                 "source": "FALLBACK_REGEX",
-                "rows": parsed_rows
+                "rows": buffer
             })
 
     return "\n".join(raw_text_lines), tables
@@ -181,15 +319,13 @@ def lambda_handler(event, context):
 
     try:
         # Step 2: Run your existing Textract logic to get raw_text and tables.
-        # NO CHANGES were made to this logic.
         job_id = start_textract_job(bucket, key)
         print(f"Started Textract job {job_id} for {key}")
         
         if not is_job_complete(job_id):
             raise Exception(f"Textract job {job_id} failed on {key}")
 
-        all_blocks = get_all_textract_blocks(job_id)
-        raw_text, tables = extract_text_and_tables(all_blocks)
+        raw_text, tables = extract_text_and_tables(get_textract_pages(job_id))
 
         # Step 3: Create the full data payload to be saved.
         output_data = {
@@ -201,12 +337,20 @@ def lambda_handler(event, context):
         }
 
         # Step 4: Save the full payload to a new JSON file in S3.
-        s3_client.put_object(
-            Bucket=PROCESSING_BUCKET,
-            Key=output_key,
-            Body=json.dumps(output_data, indent=2),
-            ContentType='application/json'
-        )
+        # The file is only read by the next Lambda, so it is written compactly. json.dump
+        # encodes it chunk by chunk into the buffer instead of building one large string.
+        with io.BytesIO() as output_buffer:
+            text_buffer = io.TextIOWrapper(output_buffer, encoding="utf-8")
+            json.dump(output_data, text_buffer, separators=(",", ":"))
+            text_buffer.detach()
+            output_buffer.seek(0)
+            s3_client.upload_fileobj(
+                output_buffer,
+                PROCESSING_BUCKET,
+                output_key,
+                ExtraArgs={'ContentType': 'application/json'},
+                Config=UPLOAD_TRANSFER_CONFIG
+            )
         print(f"Successfully saved extracted data to s3://{PROCESSING_BUCKET}/{output_key}")
 
         # Step 5: Return ONLY the location of the output file.
@@ -1,9 +1,22 @@
 import boto3
 import logging
+import os
+import time
+from botocore.config import Config
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
-s3_client = boto3.client('s3')
+# Created once per container (Lambda INIT) and reused, with its connection, across warm invocations.
+client_config = Config(
+    retries={'max_attempts': 3, 'mode': 'standard'},
+    tcp_keepalive=True
+)
+s3_client = boto3.client('s3', config=client_config)
+
+# How long a warm container may reuse the last lookup without listing the prefix again.
+# Off by default: a template uploaded inside the window would otherwise be missed.
+LATEST_CACHE_TTL_SECONDS = float(os.environ.get('LATEST_TEMPLATE_CACHE_TTL', '0'))
+_latest_cache = {'key': None, 'ts': 0.0}
 
 def lambda_handler(event, context):
     """
@@ -13,6 +26,13 @@ def lambda_handler(event, context):
     processing_bucket = "de-processing-bucket"
     template_prefix = "DE_Templates/"
     
+    if _latest_cache['key'] and time.time() - _latest_cache['ts'] < LATEST_CACHE_TTL_SECONDS:
+        logger.info(f"Using cached latest template: {_latest_cache['key']}")
+        return {
+            "s3_bucket": processing_bucket,
+            "s3_key": _latest_cache['key']
+        }
+
     try:
         # List all objects in the specified prefix
         response = s3_client.list_objects_v2(
@@ -23,12 +43,14 @@ def lambda_handler(event, context):
         if 'Contents' not in response or not response['Contents']:
             raise ValueError(f"No templates found in s3://{processing_bucket}/{template_prefix}")
 
-        # Filter out any "folder" objects and sort by last modified time, descending
+        # Filter out any "folder" objects and pick the most recently modified one
         all_files = [obj for obj in response['Contents'] if obj['Key'] != template_prefix]
-        latest_template = sorted(all_files, key=lambda obj: obj['LastModified'], reverse=True)[0]
+        latest_template = max(all_files, key=lambda obj: obj['LastModified'])
         
         latest_key = latest_template['Key']
         logger.info(f"Found latest template: {latest_key}")
+        _latest_cache['key'] = latest_key
+        _latest_cache['ts'] = time.time()
         
         # Return the location of the latest template file
         return {
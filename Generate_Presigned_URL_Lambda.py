@@ -6,6 +6,26 @@ logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 s3_client = boto3.client('s3')
 BUCKET_NAME = os.environ.get('UPLOAD_BUCKET', 'incoming-sop')
+
+# Allowed content types and the S3 folder for each upload category
+TEMPLATE_CONTENT_TYPES = frozenset({
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',  # .xlsx
+    'application/vnd.ms-excel'  # .xls
+})
+SOP_CONTENT_TYPES = frozenset({
+    'application/pdf',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml.document',  # .docx
+    'application/msword'  # .doc
+})
+CATEGORY_FOLDERS = {
+    'template': "DE_Templates",  # Updated to match your S3 path
+    'sop': "SOP"  # Matches your S3 path
+}
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Headers': 'Content-Type',
+    'Access-Control-Allow-Methods': 'POST,OPTIONS'
+}
 def lambda_handler(event, context):
     logger.info(f"Received event: {json.dumps(event)}")
     
@@ -19,32 +39,19 @@ def lambda_handler(event, context):
             raise ValueError("Missing 'filename' or 'contentType' in request body")
         
         # Validate file category and content type
+        # Non-string values (e.g. a JSON list) are unhashable, so they are rejected before the lookups.
+        folder = CATEGORY_FOLDERS.get(file_category) if isinstance(file_category, str) else None
+        if folder is None:
+            raise ValueError(f"Invalid file category: {file_category}. Must be 'sop' or 'template'")
+
         if file_category == 'template':
-            allowed_types = [
-                'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',  # .xlsx
-                'application/vnd.ms-excel'  # .xls
-            ]
-            if content_type not in allowed_types:
+            if not isinstance(content_type, str) or content_type not in TEMPLATE_CONTENT_TYPES:
                 raise ValueError(f"Invalid content type for template file: {content_type}. Must be Excel file (.xlsx or .xls)")
-            
-            folder = "DE_Templates"  # Updated to match your S3 path
             logger.info(f"Processing template file: {filename}")
-            
-        elif file_category == 'sop':
-            # Validate SOP file types (existing logic)
-            allowed_sop_types = [
-                'application/pdf',
-                'application/vnd.openxmlformats-officedocument.wordprocessingml.document',  # .docx
-                'application/msword'  # .doc
-            ]
-            if content_type not in allowed_sop_types:
+        else:
+            if not isinstance(content_type, str) or content_type not in SOP_CONTENT_TYPES:
                 raise ValueError(f"Invalid content type for SOP file: {content_type}. Must be PDF or Word document")
-            
-            folder = "SOP"  # Matches your S3 path
             logger.info(f"Processing SOP file: {filename}")
-            
-        else:
-            raise ValueError(f"Invalid file category: {file_category}. Must be 'sop' or 'template'")
         
         # Sanitize filename to prevent directory traversal
         filename = os.path.basename(filename)
@@ -64,11 +71,7 @@ def lambda_handler(event, context):
         logger.info(f"Generated pre-signed URL for {s3_key} with Content-Type {content_type}")
         return {
             'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Allow-Methods': 'POST,OPTIONS'
-            },
+            'headers': CORS_HEADERS,
             'body': json.dumps({
                 'uploadURL': presigned_url, 
                 'key': s3_key,
@@ -79,11 +82,7 @@ def lambda_handler(event, context):
         logger.error(f"Validation error: {ve}")
         return {
             'statusCode': 400,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Allow-Methods': 'POST,OPTIONS'
-            },
+            'headers': CORS_HEADERS,
             'body': json.dumps({'error': str(ve)})
         }
     
@@ -91,10 +90,6 @@ def lambda_handler(event, context):
         logger.error(f"Error generating pre-signed URL: {e}", exc_info=True)
         return {
             'statusCode': 500,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Allow-Methods': 'POST,OPTIONS'
-            },
+            'headers': CORS_HEADERS,
             'body': json.dumps({'error': 'Internal server error'})
         }
@@ -1,53 +1,139 @@
 import re
 import boto3
+import codecs
 import json
+import os
+import tempfile
 import traceback
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 
 # --- Configuration Section ---
 METADATA_KEYWORDS = {"Responsible", "Accountable", "Consulted", "Informed"}
 REVISION_HEADERS = ["Version", "Date", "Description", "Contributor"]
-
-
-HEADING_REGEX = re.compile(
-    r"^(\d+(?:\.\d+)*\s+(?!"
-    r"\d+(?:\.\d+)*\s*$|"
-    r"and\s+\d+\s*$|"
-    r"and\s+Box\s+\d+\s*$|"
-    r"with\s+\w+(?:'\w+)?\s*$|"
-    r"for\s+\w+\s*$|"
-    r"threshold\s+for\s*$|"
-    r"\w{3,9}\s+\d{1,2},\s+\d{4}\s*$|"
-    r"\d{4}\s+period\s*$|"
-    r"Added\s+[A-Z&\s]+\s*$"
-    r").{3,})$",
+REVISION_HEADERS_SET = frozenset(REVISION_HEADERS)
+
+
+# A heading is a line "<number> <title>", e.g. "4.2 Data Retention", i.e. the pattern
+#   ^(\d+(?:\.\d+)*\s+(?!<HEADING_REJECT_REGEX>).{3,})$   (MULTILINE | IGNORECASE)
+# It is matched in two steps: section numbers at line starts are found first, and the
+# title and rejection checks only run for those candidates (see _find_headings).
+HEADING_NUMBER_REGEX = re.compile(r"\d+(?:\.\d+)*(?=\s)")
+LINE_HEADING_NUMBER_REGEX = re.compile(r"\n(\d+(?:\.\d+)*)(?=\s)")
+HEADING_SPACE_REGEX = re.compile(r"\s+")
+
+# Titles that look like a number followed by a date, a cross-reference or a fragment, not a heading.
+HEADING_REJECT_REGEX = re.compile(
+    r"(?:"
+    r"\d+(?:\.\d+)*|"
+    r"and\s+(?:\d+|Box\s+\d+)|"
+    r"with\s+\w+(?:'\w+)?|"
+    r"for\s+\w+|"
+    r"threshold\s+for|"
+    r"\w{3,9}\s+\d{1,2},\s+\d{4}|"
+    r"\d{4}\s+period|"
+    r"Added\s+[A-Z&\s]+"
+    r")\s*$",
     re.MULTILINE | re.IGNORECASE
 )
 
 
 MAIN_SECTION_REGEX = re.compile(r"^\d+\s")
 
-# Initialize S3 client once for better performance
-s3_client = boto3.client("s3")
+# Initialize S3 client once for better performance; warm invocations reuse its
+# keep-alive connections.
+client_config = Config(
+    retries={"max_attempts": 3, "mode": "adaptive"},
+    tcp_keepalive=True,
+    max_pool_connections=20
+)
+s3_client = boto3.client("s3", config=client_config)
 
+# Structured SOPs above 8 MB are uploaded in 16 MB parts, up to 10 at a time
+UPLOAD_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=16 * 1024 * 1024,
+    max_concurrency=10
+)
 
-# --- NO CHANGES TO YOUR CORE LOGIC BELOW THIS LINE ---
+# Serialized output is kept in memory up to this size before spilling to /tmp
+SPOOL_MAX_BYTES = 8 * 1024 * 1024
 
-def _parse_sections(raw_text):
+# Structured SOPs up to this size (serialized bytes) are also returned inline, so the analysis
+# step can skip reading them back from S3. Keeps well under the 256 KB Step Functions payload limit.
+INLINE_RESULT_MAX_BYTES = int(os.environ.get("INLINE_RESULT_MAX_BYTES", "65536"))
+
+
+# --- Core Logic Section ---
+
+def _heading_line_end(raw_text, space_start):
+    # For a section number ending at space_start, returns the end of its heading line, or
+    # None if the line is not a heading. Matches the single heading regex described above:
+    # the whitespace after the number is tried longest first, and the title must not match
+    # a rejection and must leave at least 3 characters before the end of its line.
+    title_start = HEADING_SPACE_REGEX.match(raw_text, space_start).end()
+    while title_start > space_start:
+        line_end = raw_text.find("\n", title_start)
+        if line_end == -1:
+            line_end = len(raw_text)
+        if line_end - title_start >= 3 and not HEADING_REJECT_REGEX.match(raw_text, title_start):
+            return line_end
+        title_start -= 1
+    return None
+
+
+def _find_headings(raw_text):
+    # Returns (text, start, end) for each heading line. Candidates are found by searching
+    # for "\n" followed by a section number, which lets the regex engine skip ahead to
+    # newlines; after a heading, the search resumes at the end of its line.
     headings = []
-    for match in HEADING_REGEX.finditer(raw_text):
-        headings.append({
-            "heading": match.group(1).strip(),
-            "start": match.start(),
-            "end": match.end()
-        })
+    append = headings.append
+    search = LINE_HEADING_NUMBER_REGEX.search
+    pos = 0
+
+    first_number = HEADING_NUMBER_REGEX.match(raw_text)
+    if first_number:
+        line_end = _heading_line_end(raw_text, first_number.end())
+        if line_end is not None:
+            append((raw_text[:line_end], 0, line_end))
+            pos = line_end
+
+    while True:
+        number = search(raw_text, pos)
+        if number is None:
+            break
+        start, space_start = number.span(1)
+        line_end = _heading_line_end(raw_text, space_start)
+        if line_end is None:
+            pos = space_start
+        else:
+            append((raw_text[start:line_end], start, line_end))
+            pos = line_end
+    return headings
 
-    content_map = {}
-    for i, head in enumerate(headings):
-        content_start = head["end"]
-        content_end = headings[i + 1]["start"] if i + 1 < len(headings) else len(raw_text)
-        content_map[head["heading"]] = raw_text[content_start:content_end].strip()
 
-    return headings, content_map
+def _parse_sections(raw_text):
+    # Yields (heading, content) for each heading in document order. A heading's content
+    # is the text between it and the next heading (or the end of the text).
+    previous_heading = previous_end = None
+    for heading, start, end in _find_headings(raw_text):
+        if previous_heading is not None:
+            yield previous_heading, raw_text[previous_end:start].strip()
+        previous_heading, previous_end = heading.strip(), end
+    if previous_heading is not None:
+        yield previous_heading, raw_text[previous_end:].strip()
+
+
+def _has_metadata_keyword(rows):
+    # True if any cell contains one of the metadata keywords. Cells are checked one by one,
+    # so the whole table is never rendered into one string just to be searched.
+    for row in rows:
+        for cell in row:
+            if isinstance(cell, str):
+                for keyword in METADATA_KEYWORDS:
+                    if keyword in cell:
+                        return True
+    return False
 
 
 def _categorize_tables(tables):
@@ -56,25 +142,32 @@ def _categorize_tables(tables):
     body_tables = []
     is_revision_section = False
 
+    revision_extend = revision_rows.extend
+    body_append = body_tables.append
+    revision_column_count = len(REVISION_HEADERS)
+
     for table in tables:
-        rows = table.get("rows", [])
+        rows = table.get("rows")
         if not rows:
             continue
 
         header = rows[0]
 
-        if not metadata_table and any(kw in str(rows) for kw in METADATA_KEYWORDS):
+        if not metadata_table and _has_metadata_keyword(rows):
             metadata_table = table
             continue
 
-        if set(header) == set(REVISION_HEADERS):
+        # A header needs at least one cell per revision column to match (it may repeat one),
+        # so most tables are rejected on length before a set is built.
+        header_length = len(header)
+        if header_length >= revision_column_count and frozenset(header) == REVISION_HEADERS_SET:
             is_revision_section = True
-            revision_rows.extend(rows[1:])
-        elif is_revision_section and len(header) == len(REVISION_HEADERS):
-            revision_rows.extend(rows)
+            revision_extend(rows[1:])
+        elif is_revision_section and header_length == revision_column_count:
+            revision_extend(rows)
         else:
             is_revision_section = False
-            body_tables.append(table)
+            body_append(table)
 
     return metadata_table, revision_rows, body_tables
 
@@ -84,14 +177,15 @@ def SOP_Structure_Formation(sop_data):
     tables = sop_data.get("tables", [])
 
     metadata_table, revision_table_data, remaining_tables = _categorize_tables(tables)
-    headings, content_map = _parse_sections(raw_text)
 
+    # Headings are consumed as they are found: each one is added to the table of contents
+    # and placed in the body in the same pass.
+    headings = []
     structured_body = []
     current_section = None
 
-    for head_info in headings:
-        heading = head_info["heading"]
-        content_text = content_map.get(heading, "").strip()
+    for heading, content_text in _parse_sections(raw_text):
+        headings.append(heading)
 
         if MAIN_SECTION_REGEX.match(heading):
             if current_section:
@@ -105,38 +199,32 @@ def SOP_Structure_Formation(sop_data):
     if current_section:
         structured_body.append(current_section)
 
-    final_output = []
-
-    if metadata_table:
-        final_output.append({
-            "Section": "Document Information",
-            "Metadata": {row[0]: row[1] for row in metadata_table.get("rows", []) if len(row) == 2}
-        })
-
-    if headings:
-        final_output.append({
-            "Section": "Table of Contents",
-            "Content": [h["heading"] for h in headings]
-        })
-
-    final_output.extend(structured_body)
-
-    if revision_table_data:
-        final_output.append({
-            "Section": "Revision History",
-            "Table": [dict(zip(REVISION_HEADERS, row)) for row in revision_table_data]
-        })
-
-    if remaining_tables:
-        final_output.append({
-            "Section": "Extracted Tables",
-            "Tables": [{
-                "Table #": i + 1,
-                "Page": table.get("page"), "Source": table.get("source"), "Rows": table.get("rows")
-            } for i, table in enumerate(remaining_tables)]
-        })
-
-    return final_output
+    # Each optional block is an empty list when it does not apply, so the output is
+    # assembled in a single list display.
+    document_information = [{
+        "Section": "Document Information",
+        "Metadata": {row[0]: row[1] for row in metadata_table.get("rows", []) if len(row) == 2}
+    }] if metadata_table else []
+
+    table_of_contents = [{
+        "Section": "Table of Contents",
+        "Content": headings
+    }] if headings else []
+
+    revision_history = [{
+        "Section": "Revision History",
+        "Table": [dict(zip(REVISION_HEADERS, row)) for row in revision_table_data]
+    }] if revision_table_data else []
+
+    extracted_tables = [{
+        "Section": "Extracted Tables",
+        "Tables": [{
+            "Table #": i + 1,
+            "Page": table.get("page"), "Source": table.get("source"), "Rows": table.get("rows")
+        } for i, table in enumerate(remaining_tables)]
+    }] if remaining_tables else []
+
+    return [*document_information, *table_of_contents, *structured_body, *revision_history, *extracted_tables]
 
 # --- UPDATED LAMBDA HANDLER SECTION ---
 # This handler is now designed to work correctly within the Step Function.
@@ -156,11 +244,11 @@ def lambda_handler(event, context):
         print(f"Reading input data from: s3://{input_bucket}/{input_key}")
 
         # Step 2: Read the JSON file from S3 to get the raw text and tables.
+        # json.load parses the raw bytes, so no intermediate decoded copy is made.
         response = s3_client.get_object(Bucket=input_bucket, Key=input_key)
-        sop_data_from_s3 = json.loads(response['Body'].read().decode('utf-8'))
+        sop_data_from_s3 = json.load(response['Body'])
 
         # Step 3: Run your existing core structuring logic on the loaded data.
-        # NO CHANGES were made to this function.
         structured_result = SOP_Structure_Formation(sop_data_from_s3)
 
         # Step 4: Define the output file path.
@@ -172,20 +260,33 @@ def lambda_handler(event, context):
         output_key = f"processed-sop/{output_filename}"
 
         # Step 5: Save the structured result to a new file in S3.
-        s3_client.put_object(
-            Bucket=output_bucket,
-            Key=output_key,
-            Body=json.dumps(structured_result, indent=2),
-            ContentType="application/json"
-        )
+        # The file is only read by the analysis Lambda, so it is written without indentation.
+        # json.dump encodes it chunk by chunk into a spooled file (in memory until it grows
+        # past SPOOL_MAX_BYTES, then on /tmp), so the full JSON string is never built.
+        # upload_fileobj switches to a concurrent multipart upload for large results.
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES) as output_file:
+            json.dump(structured_result, codecs.getwriter("utf-8")(output_file), separators=(",", ":"))
+            body_size = output_file.tell()
+            output_file.seek(0)
+            s3_client.upload_fileobj(
+                output_file,
+                output_bucket,
+                output_key,
+                ExtraArgs={"ContentType": "application/json"},
+                Config=UPLOAD_TRANSFER_CONFIG
+            )
         print(f"Successfully saved structured SOP to: s3://{output_bucket}/{output_key}")
 
-        # Step 6: Return ONLY the location of the new file.
+        # Step 6: Return the location of the new file.
         # This small, clean output fixes the error in the next Step Function step.
-        return {
+        output = {
             "s3_bucket": output_bucket,
             "s3_key": output_key
         }
+        # Small results are passed along in the payload as well; the S3 copy stays the record.
+        if body_size <= INLINE_RESULT_MAX_BYTES:
+            output["inline"] = structured_result
+        return output
 
     except Exception as e:
         print(f"An error occurred: {e}")